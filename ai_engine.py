@@ -1,6 +1,8 @@
+import asyncio
 import logging
 import os
-from typing import Dict, Any
+from typing import AsyncIterator, Dict, Any
+import httpx
 from openai import AsyncOpenAI
 
 # Configure logging
@@ -12,13 +14,32 @@ BASE_URL = "https://models.github.ai/inference/v1"
 API_KEY = ""
 MODEL_NAME = "openai/gpt-4.1-nano"
 
+# Max concurrent upstream calls per process (avoids 429 storms)
+CONCURRENCY_LIMIT = 64
+
 # Debug: Log the loaded values
-logger.info(f"Loaded BASE_URL: {BASE_URL}")
-logger.info(f"Loaded API_KEY: {API_KEY[:20]}...")
-logger.info(f"Loaded MODEL_NAME: {MODEL_NAME}")
+logger.info("Loaded BASE_URL: %s", BASE_URL)
+logger.info("Loaded API_KEY: %s...", API_KEY[:20])
+logger.info("Loaded MODEL_NAME: %s", MODEL_NAME)
+
+# Shared HTTP/2 connection pool so requests reuse warm TLS connections
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=200,
+        max_keepalive_connections=200,
+        keepalive_expiry=60
+    ),
+    timeout=httpx.Timeout(30.0, connect=5.0)
+)
 
 # Initialize OpenAI client (using AsyncOpenAI like the travel agent)
-openai_client = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
+openai_client = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY, http_client=http_client)
+
+upstream_semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
+
+# Built once and shared by every request
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful AI assistant. Provide clear, concise, and helpful responses."}
 
 
 class AIEngine:
@@ -29,29 +50,53 @@ class AIEngine:
         """
         Generate AI response for the given query using OpenAI.
         """
-        logger.info(f"Generating AI response for query: {query}")
+        logger.debug("Generating AI response for query: %s", query)
         
         try:
             # Call OpenAI API (async like the travel agent)
-            response = await openai_client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[
-                    {"role": "system", "content": "You are a helpful AI assistant. Provide clear, concise, and helpful responses."},
-                    {"role": "user", "content": query}
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
+            async with upstream_semaphore:
+                response = await openai_client.chat.completions.create(
+                    model=MODEL_NAME,
+                    messages=(SYSTEM_MESSAGE, {"role": "user", "content": query}),
+                    max_tokens=500,
+                    temperature=0.7
+                )
             
             ai_response = response.choices[0].message.content
-            logger.info(f"Generated AI response: {ai_response[:100]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Generated AI response: %s...", ai_response[:100])
             return ai_response
             
         except Exception as e:
-            logger.error(f"Error generating AI response: {e}")
+            logger.error("Error generating AI response: %s", e)
             # Fallback to mock response if API fails
             return f"AI response to: {query} (API Error: {str(e)})"
     
+    @staticmethod
+    async def stream_response(query: str) -> AsyncIterator[str]:
+        """
+        Stream the AI response for the given query as it is generated.
+        """
+        logger.debug("Streaming AI response for query: %s", query)
+        
+        try:
+            async with upstream_semaphore:
+                stream = await openai_client.chat.completions.create(
+                    model=MODEL_NAME,
+                    messages=(SYSTEM_MESSAGE, {"role": "user", "content": query}),
+                    max_tokens=500,
+                    temperature=0.7,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            
+        except Exception as e:
+            logger.error("Error streaming AI response: %s", e)
+            # Deltas may already have been sent, so let the caller decide
+            raise
+    
     @staticmethod
     async def process_query(query: str) -> Dict[str, Any]:
         """
@@ -68,5 +113,5 @@ class AIEngine:
                 "timestamp": None  # Will be set by cache layer
             }
         except Exception as e:
-            logger.error(f"Error processing query: {e}")
+            logger.error("Error processing query: %s", e)
             raise
@@ -1,76 +1,455 @@
+import asyncio
+import socket
+import weakref
 import redis
-import json
+import redis.asyncio as aioredis
+import orjson
+import zstandard as zstd
+from cachetools import TTLCache
 import logging
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, List, Tuple
 import os
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Delete the lock only if it still holds our token, so a slow leader can't
+# release a lock that already expired and was taken by someone else
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Return the cached value if present, otherwise try to take the key's lock,
+# so the stampede-safe miss path costs a single round-trip
+GET_OR_LOCK_SCRIPT = """
+local v = redis.call('get', KEYS[1])
+if v then
+    return {1, v}
+end
+local ok = redis.call('set', KEYS[2], ARGV[1], 'NX', 'PX', ARGV[2])
+return {0, ok and 'leader' or 'waiter'}
+"""
+
+# Read a key, extending its TTL only once less than half of it remains. Hot
+# keys still slide, but a hit isn't a write every time: with client tracking
+# each PEXPIRE broadcasts an invalidation that evicts the key in every process
+GET_AND_REFRESH_SCRIPT = """
+local v = redis.call('get', KEYS[1])
+if v and redis.call('pttl', KEYS[1]) < tonumber(ARGV[1]) / 2 then
+    redis.call('pexpire', KEYS[1], ARGV[1])
+end
+return v
+"""
+
+# Sorted-set concurrency limiter: members are in-flight request ids scored by
+# start time; entries older than the TTL are treated as abandoned. Reserves
+# the requested ids (ARGV[4..]) in order while slots are free and returns how
+# many were reserved
+ACQUIRE_SLOTS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now - ttl)
+local granted = math.min(tonumber(ARGV[3]) - redis.call('zcard', KEYS[1]), #ARGV - 3)
+if granted <= 0 then
+    return 0
+end
+for i = 4, 3 + granted do
+    redis.call('zadd', KEYS[1], now, ARGV[i])
+end
+redis.call('pexpire', KEYS[1], ttl)
+return granted
+"""
+
+# Backoff between attempts to re-establish invalidation tracking (seconds)
+TRACKING_RETRY_MIN = 1.0
+TRACKING_RETRY_MAX = 30.0
+
+# Cached payloads are a version byte followed by zstd-compressed JSON
+PAYLOAD_VERSION = b"\x01"
+_compressor = zstd.ZstdCompressor(level=3)
+_decompressor = zstd.ZstdDecompressor()
+
+def encode_payload(value: Dict[str, Any]) -> bytes:
+    """Serialize and compress a cached response"""
+    return PAYLOAD_VERSION + _compressor.compress(orjson.dumps(value))
+
+def decode_payload(payload: bytes) -> Dict[str, Any]:
+    """Decode a cached response written by encode_payload"""
+    if payload[:1] == PAYLOAD_VERSION:
+        return orjson.loads(_decompressor.decompress(payload[1:]))
+    # Entries written before compression are plain JSON
+    return orjson.loads(payload)
+
 class RedisCache:
     """Redis cache manager for AI chatbot responses"""
     
-    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0):
-        """Initialize Redis connection"""
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0,
+                 max_connections: int = 128, local_maxsize: int = 1024,
+                 local_ttl: int = 600, unix_socket_path: Optional[str] = None,
+                 client_tracking: bool = True, tracking_prefix: str = "q:"):
+        """
+        Initialize Redis client (connections are opened lazily by the pool).
+        
+        If unix_socket_path is given it is used instead of host/port. With
+        client_tracking, Redis broadcasts invalidations for keys starting with
+        tracking_prefix so the in-process tier never serves values changed
+        elsewhere; while tracking is down the in-process tier is bypassed.
+        """
+        self.location = unix_socket_path or f"{host}:{port}"
+        self.client_tracking = client_tracking
+        self.tracking_prefix = tracking_prefix
+        self._tracking_task: Optional[asyncio.Task] = None
+        # Without tracking, local entries are only bounded by their TTL
+        self._local_enabled = not client_tracking
+        if unix_socket_path:
+            connection_kwargs = {
+                "connection_class": aioredis.UnixDomainSocketConnection,
+                "path": unix_socket_path
+            }
+        else:
+            connection_kwargs = {
+                "host": host,
+                "port": port,
+                # Probe idle connections so NATs/load balancers don't drop them silently
+                "socket_keepalive": True,
+                "socket_keepalive_options": {
+                    socket.TCP_KEEPIDLE: 30,
+                    socket.TCP_KEEPINTVL: 10,
+                    socket.TCP_KEEPCNT: 3
+                }
+            }
+        # Blocks (up to 5s) for a free connection instead of opening unbounded ones
+        pool = aioredis.BlockingConnectionPool(
+            db=db,
+            max_connections=max_connections,
+            timeout=5,
+            decode_responses=False,
+            **connection_kwargs
+        )
+        self.redis_client = aioredis.Redis(connection_pool=pool)
+        # Scripts are loaded once (SCRIPT LOAD) and invoked via EVALSHA
+        self._release_lock = self.redis_client.register_script(RELEASE_LOCK_SCRIPT)
+        self._get_or_lock = self.redis_client.register_script(GET_OR_LOCK_SCRIPT)
+        self._get_and_refresh = self.redis_client.register_script(GET_AND_REFRESH_SCRIPT)
+        self._acquire_slots = self.redis_client.register_script(ACQUIRE_SLOTS_SCRIPT)
+        # In-process tier in front of Redis for the hottest keys
+        self.local_cache = TTLCache(maxsize=local_maxsize, ttl=local_ttl)
+        self._local_locks: "weakref.WeakValueDictionary[bytes, asyncio.Lock]" = weakref.WeakValueDictionary()
+    
+    def _local_lock(self, key: bytes) -> asyncio.Lock:
+        """Per-key lock, dropped automatically once no coroutine holds it"""
+        lock = self._local_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._local_locks[key] = lock
+        return lock
+    
+    def _remember(self, key: bytes, value: Dict[str, Any]) -> None:
+        """Store a value in the in-process tier if it can currently be trusted"""
+        if self._local_enabled:
+            self.local_cache[key] = value
+    
+    async def _open_tracking(self) -> Tuple[Any, Any]:
+        """
+        Open the connection receiving invalidation messages and a second one
+        that enables broadcast tracking on its behalf. Raises ResponseError on
+        servers without CLIENT TRACKING (Redis < 6).
+        """
+        pool = self.redis_client.connection_pool
+        listener = pool.connection_class(**pool.connection_kwargs)
+        tracker = pool.connection_class(**pool.connection_kwargs)
         try:
-            self.redis_client = redis.Redis(
-                host=host, 
-                port=port, 
-                db=db, 
-                decode_responses=True
+            await listener.connect()
+            await listener.send_command("CLIENT", "ID")
+            client_id = await listener.read_response()
+            await listener.send_command("SUBSCRIBE", "__redis__:invalidate")
+            await listener.read_response()
+            # BCAST PREFIX: any write to a cache key is reported, while lock:
+            # and concur: keys used by the scripts generate no traffic
+            await tracker.connect()
+            await tracker.send_command(
+                "CLIENT", "TRACKING", "ON", "REDIRECT", client_id,
+                "BCAST", "PREFIX", self.tracking_prefix
             )
-            # Test connection
-            self.redis_client.ping()
-            logger.info(f"Connected to Redis at {host}:{port}")
-        except redis.ConnectionError as e:
-            logger.error(f"Failed to connect to Redis: {e}")
+            await tracker.read_response()
+        except BaseException:
+            await listener.disconnect()
+            await tracker.disconnect()
             raise
+        return listener, tracker
     
-    def get(self, key: str) -> Optional[Dict[str, Any]]:
-        """Get cached response by query"""
-        try:
-            cached_data = self.redis_client.get(key)
-            if cached_data:
-                logger.info(f"Cache HIT for query: {key}")
-                return json.loads(cached_data)
+    async def _listen_invalidations(self, listener) -> None:
+        """Evict local entries whose Redis keys were modified or expired"""
+        while True:
+            message = await listener.read_response()
+            if message[0] != b"message":
+                continue
+            keys = message[2]
+            if keys is None:
+                # Sent on FLUSHDB / FLUSHALL
+                self.local_cache.clear()
             else:
-                logger.info(f"Cache MISS for query: {key}")
+                for key in keys:
+                    self.local_cache.pop(key, None)
+    
+    async def _track_invalidations(self, connections: Optional[Tuple[Any, Any]]) -> None:
+        """Keep invalidation tracking alive, reconnecting with backoff when it drops"""
+        delay = TRACKING_RETRY_MIN
+        while True:
+            try:
+                if connections is None:
+                    connections = await self._open_tracking()
+                    logger.info("Redis invalidation tracking restored")
+                delay = TRACKING_RETRY_MIN
+                self._local_enabled = True
+                await self._listen_invalidations(connections[0])
+            except Exception as e:
+                logger.error("Lost Redis invalidation connection: %s", e)
+            finally:
+                # Without invalidations the local tier could serve stale values
+                self._local_enabled = False
+                self.local_cache.clear()
+                if connections is not None:
+                    for connection in connections:
+                        await connection.disconnect()
+                    connections = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, TRACKING_RETRY_MAX)
+    
+    async def connect(self) -> None:
+        """Test the Redis connection"""
+        try:
+            if self.client_tracking:
+                try:
+                    connections = await self._open_tracking()
+                except redis.ResponseError as e:
+                    logger.warning("Client-side caching unavailable: %s", e)
+                    # Fall back to TTL-bounded local entries
+                    self.client_tracking = False
+                    self._local_enabled = True
+                else:
+                    self._tracking_task = asyncio.create_task(self._track_invalidations(connections))
+            await self.redis_client.ping()
+            for script in (self._release_lock, self._get_or_lock, self._get_and_refresh,
+                           self._acquire_slots):
+                await self.redis_client.script_load(script.script)
+            logger.info("Connected to Redis at %s", self.location)
+        except redis.ConnectionError as e:
+            logger.error("Failed to connect to Redis: %s", e)
+            raise
+    
+    async def close(self) -> None:
+        """Stop invalidation tracking and close all pooled connections"""
+        if self._tracking_task is not None:
+            self._tracking_task.cancel()
+            try:
+                await self._tracking_task
+            except asyncio.CancelledError:
+                pass
+            self._tracking_task = None
+        await self.redis_client.aclose()
+        await self.redis_client.connection_pool.disconnect()
+    
+    async def get(self, key: bytes, expiration: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Get cached response by query.
+        
+        Checks the in-process cache first and only then Redis; concurrent
+        local misses for the same key share a single Redis lookup. If
+        expiration is given, a hit whose Redis TTL has fallen below half of it
+        is extended in the same round-trip (sliding expiration for hot keys).
+        """
+        cached = self.local_cache.get(key)
+        if cached is not None:
+            logger.debug("Local cache HIT for query: %s", key)
+            return cached
+        
+        async with self._local_lock(key):
+            # Another coroutine may have filled the local cache while we waited
+            cached = self.local_cache.get(key)
+            if cached is not None:
+                logger.debug("Local cache HIT for query: %s", key)
+                return cached
+            try:
+                if expiration is None:
+                    cached_data = await self.redis_client.get(key)
+                else:
+                    cached_data = await self._get_and_refresh(keys=[key], args=[expiration * 1000])
+                if cached_data:
+                    logger.debug("Cache HIT for query: %s", key)
+                    cached = decode_payload(cached_data)
+                    self._remember(key, cached)
+                    return cached
+                else:
+                    logger.debug("Cache MISS for query: %s", key)
+                    return None
+            except Exception as e:
+                logger.error("Error getting from cache: %s", e)
                 return None
-        except Exception as e:
-            logger.error(f"Error getting from cache: {e}")
-            return None
     
-    def set(self, key: str, value: Dict[str, Any], expiration: int = 600) -> bool:
-        """Set cached response with expiration (default 10 minutes)"""
+    async def set(self, key: bytes, value: Dict[str, Any], expiration: int = 600,
+                  notify: bool = False) -> bool:
+        """
+        Set cached response with expiration (default 10 minutes).
+        
+        With notify=True, requests waiting on the key (see wait_for) are
+        notified in the same round-trip as the write.
+        """
         try:
-            serialized_value = json.dumps(value)
-            result = self.redis_client.setex(key, expiration, serialized_value)
-            logger.info(f"Cached response for query: {key} (expires in {expiration}s)")
+            serialized_value = encode_payload(value)
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.setex(key, expiration, serialized_value)
+                if notify:
+                    pipe.publish(b"chan:" + key, "ready")
+                result = (await pipe.execute())[0]
+            if not self.client_tracking:
+                # With tracking, this write's own invalidation would evict the
+                # entry again; the next get fills the local tier instead
+                self._remember(key, value)
+            logger.debug("Cached response for query: %s (expires in %ss)", key, expiration)
             return result
         except Exception as e:
-            logger.error(f"Error setting cache: {e}")
+            logger.error("Error setting cache: %s", e)
             return False
     
-    def delete(self, key: str) -> bool:
+    async def get_many(self, keys: List[bytes]) -> List[Optional[Dict[str, Any]]]:
+        """Get cached responses for many keys; local misses share one MGET"""
+        results = [self.local_cache.get(key) for key in keys]
+        missing = [i for i, cached in enumerate(results) if cached is None]
+        if not missing:
+            return results
+        try:
+            values = await self.redis_client.mget([keys[i] for i in missing])
+            for i, value in zip(missing, values):
+                if value:
+                    results[i] = decode_payload(value)
+                    self._remember(keys[i], results[i])
+        except Exception as e:
+            logger.error("Error getting from cache: %s", e)
+        return results
+    
+    async def delete(self, key: bytes) -> bool:
         """Delete cached response"""
         try:
-            result = self.redis_client.delete(key)
-            logger.info(f"Deleted cache for query: {key}")
+            self.local_cache.pop(key, None)
+            result = await self.redis_client.delete(key)
+            logger.info("Deleted cache for query: %s", key)
             return bool(result)
         except Exception as e:
-            logger.error(f"Error deleting from cache: {e}")
+            logger.error("Error deleting from cache: %s", e)
+            return False
+    
+    async def get_or_lock(self, key: bytes, token: str,
+                          ttl_ms: int = 30000) -> Tuple[Optional[Dict[str, Any]], Optional[bool]]:
+        """
+        Atomically get the cached response or, on a miss, try to become the
+        single writer for the key (SET lock:{key} NX PX).
+        
+        Returns (cached response, False) on a hit and (None, acquired) on a
+        miss. If Redis is unavailable returns (None, None), so the caller can
+        generate right away instead of waiting for a lock holder.
+        """
+        try:
+            hit, value = await self._get_or_lock(
+                keys=[key, b"lock:" + key],
+                args=[token, ttl_ms]
+            )
+            if hit:
+                cached = decode_payload(value)
+                self._remember(key, cached)
+                return cached, False
+            return None, value == b"leader"
+        except Exception as e:
+            logger.error("Error acquiring lock: %s", e)
+            return None, None
+    
+    async def release_lock(self, key: bytes, token: str) -> bool:
+        """Release a lock previously acquired with the same token"""
+        try:
+            return bool(await self._release_lock(keys=[b"lock:" + key], args=[token]))
+        except Exception as e:
+            logger.error("Error releasing lock: %s", e)
             return False
     
-    def clear_all(self) -> bool:
+    async def acquire_slots(self, client_id: str, request_ids: List[str], limit: int,
+                            ttl_ms: int = 60000) -> int:
+        """
+        Reserve up to one of the client's concurrent request slots per id,
+        without exceeding `limit` in flight. Returns the number reserved; the
+        first that many ids hold slots (0 means the client is at its limit).
+        """
+        try:
+            return await self._acquire_slots(
+                keys=[b"concur:" + client_id.encode()],
+                args=[int(time.time() * 1000), ttl_ms, limit, *request_ids]
+            )
+        except Exception as e:
+            # Fail open: a Redis hiccup shouldn't reject every request
+            logger.error("Error acquiring request slot: %s", e)
+            return len(request_ids)
+    
+    async def refresh_slots(self, client_id: str, request_ids: List[str],
+                            ttl_ms: int = 60000) -> None:
+        """Re-stamp slots still held so long-running work isn't reaped as abandoned"""
+        key = b"concur:" + client_id.encode()
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                now = int(time.time() * 1000)
+                pipe.zadd(key, {request_id: now for request_id in request_ids}, xx=True)
+                pipe.pexpire(key, ttl_ms)
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Error refreshing request slots: %s", e)
+    
+    async def release_slots(self, client_id: str, request_ids: List[str]) -> None:
+        """Free slots reserved with acquire_slots"""
+        try:
+            await self.redis_client.zrem(b"concur:" + client_id.encode(), *request_ids)
+        except Exception as e:
+            logger.error("Error releasing request slot: %s", e)
+    
+    async def wait_for(self, key: bytes, timeout: float = 30.0) -> Optional[Dict[str, Any]]:
+        """
+        Wait until the lock holder publishes the key or the timeout expires,
+        then return the cached value (None on timeout).
+        """
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(b"chan:" + key)
+            # The leader may have finished before we subscribed
+            cached = await self.get(key)
+            if cached:
+                return cached
+            deadline = time.monotonic() + timeout
+            while (remaining := deadline - time.monotonic()) > 0:
+                if await pubsub.get_message(timeout=remaining):
+                    return await self.get(key)
+            return None
+        except Exception as e:
+            logger.error("Error waiting for cache update: %s", e)
+            return None
+        finally:
+            await pubsub.aclose()
+    
+    async def clear_all(self) -> bool:
         """Clear all cached responses"""
         try:
-            result = self.redis_client.flushdb()
+            self.local_cache.clear()
+            result = await self.redis_client.flushdb()
             logger.info("Cleared all cache")
             return result
         except Exception as e:
-            logger.error(f"Error clearing cache: {e}")
+            logger.error("Error clearing cache: %s", e)
             return False
 
 # Global cache instance
-cache = RedisCache()
+cache = RedisCache(
+    host=os.getenv("REDIS_HOST", "localhost"),
+    port=int(os.getenv("REDIS_PORT", "6379")),
+    unix_socket_path=os.getenv("REDIS_SOCKET")
+)
@@ -1,17 +1,51 @@
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+import logging.handlers
+import os
+import queue
+import re
+import unicodedata
+import uuid
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
-from typing import Dict, Any
-import hashlib
+from typing import AsyncIterator, Dict, Any, List, Optional
+import xxhash
 import time
 
 from .cache import cache
-from .ai_engine import AIEngine
+from .ai_engine import AIEngine, http_client
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Hand records to a background thread so handler I/O never blocks the event loop
+_log_queue = queue.SimpleQueue()
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_handlers: List[logging.Handler] = []
+
+# Cache settings
+CACHE_TTL = 600  # 10 minutes
+LOCK_TTL_MS = 30000  # must outlive a slow LLM call
+LOCK_WAIT_TIMEOUT = 30.0
+LOCK_POLL_INTERVAL = 0.2
+LOCK_POLL_ATTEMPTS = 10
+
+# Per-client concurrency limit
+CLIENT_CONCURRENCY_LIMIT = 5
+CLIENT_SLOT_TTL_MS = 60000  # slots of crashed requests expire after this
+
+# Max queries accepted by /chat/batch
+BATCH_MAX_QUERIES = 100
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Cache misses currently being resolved by this process, keyed by cache key
+_inflight: Dict[bytes, asyncio.Future] = {}
+
 # Initialize FastAPI app
 app = FastAPI(
     title="AI Chatbot with Redis Caching",
@@ -24,6 +58,11 @@ class ChatRequest(BaseModel):
     """Request model for chat endpoint"""
     query: str = Field(..., description="The user's question or query")
 
+class BatchChatRequest(BaseModel):
+    """Request model for batch chat endpoint"""
+    queries: List[str] = Field(..., min_length=1, max_length=BATCH_MAX_QUERIES,
+                               description="The user's questions or queries")
+
 class ChatResponse(BaseModel):
     """Response model for chat endpoint"""
     query: str
@@ -31,12 +70,219 @@ class ChatResponse(BaseModel):
     cached: bool
     timestamp: float
 
-def generate_cache_key(query: str) -> str:
+def normalize_query(query: str) -> str:
+    """
+    Canonicalize a query so trivially different spellings share a cache entry
+    (Unicode NFKC, case folding, collapsed whitespace, no trailing punctuation).
+    """
+    normalized = unicodedata.normalize("NFKC", query).casefold()
+    normalized = _WHITESPACE.sub(" ", normalized).strip()
+    return normalized.rstrip("?.!").rstrip()
+
+def generate_cache_key(query: str) -> bytes:
     """Generate a consistent cache key for the query"""
-    # Normalize query (lowercase, strip whitespace)
-    normalized_query = query.lower().strip()
-    # Create hash for consistent key length
-    return hashlib.md5(normalized_query.encode()).hexdigest()
+    normalized_query = normalize_query(query)
+    # Raw 16-byte xxh3 digest under a "q:" namespace (half the size of a hex key)
+    return b"q:" + xxhash.xxh3_128_digest(normalized_query.encode())
+
+async def generate_and_cache(query: str, cache_key: bytes) -> Dict[str, Any]:
+    """Generate an AI response, store it in Redis and notify any waiters"""
+    ai_response = await AIEngine.generate_response(query)
+    
+    response_data = {
+        "query": query,
+        "response": ai_response,
+        "cached": False,
+        "timestamp": time.time()
+    }
+    
+    # Store in cache with 10-minute expiration
+    await cache.set(cache_key, response_data, expiration=CACHE_TTL, notify=True)
+    return response_data
+
+async def wait_for_leader(cache_key: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Wait for the request holding the lock to populate the cache.
+    
+    Subscribes to the key's channel first; if no notification arrives in time
+    (missed message, slow leader) falls back to polling the cache.
+    """
+    try:
+        cached_response = await asyncio.wait_for(
+            cache.wait_for(cache_key, LOCK_WAIT_TIMEOUT),
+            timeout=LOCK_WAIT_TIMEOUT + 1
+        )
+        if cached_response:
+            return cached_response
+    except asyncio.TimeoutError:
+        logger.warning("Timed out waiting for cache key: %s", cache_key)
+    
+    for _ in range(LOCK_POLL_ATTEMPTS):
+        cached_response = await cache.get(cache_key)
+        if cached_response:
+            return cached_response
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+    return None
+
+async def resolve_miss(query: str, cache_key: bytes) -> Dict[str, Any]:
+    """
+    Produce the response for a cache miss. Only the request holding the
+    Redis lock calls the LLM; the rest wait for its result.
+    """
+    token = uuid.uuid4().hex
+    cached_response, is_leader = await cache.get_or_lock(cache_key, token, ttl_ms=LOCK_TTL_MS)
+    if cached_response:
+        # Filled by another request since our first lookup
+        return {**cached_response, "cached": True}
+    if is_leader is None:
+        # Redis unavailable - no one to wait for
+        return await generate_and_cache(query, cache_key)
+    if is_leader:
+        try:
+            return await generate_and_cache(query, cache_key)
+        finally:
+            await cache.release_lock(cache_key, token)
+    
+    cached_response = await wait_for_leader(cache_key)
+    if cached_response:
+        return {**cached_response, "cached": True}
+    # Leader never delivered (crashed or timed out) - generate ourselves
+    return await generate_and_cache(query, cache_key)
+
+async def coalesced_miss(query: str, cache_key: bytes) -> Dict[str, Any]:
+    """
+    Resolve a cache miss, sharing a single in-flight resolution among all
+    concurrent requests for the same key in this process.
+    """
+    inflight = _inflight.get(cache_key)
+    if inflight is not None:
+        # Shield so a disconnecting follower can't cancel the shared result
+        response_data = await asyncio.shield(inflight)
+        return {**response_data, "cached": True}
+    
+    inflight = asyncio.get_running_loop().create_future()
+    _inflight[cache_key] = inflight
+    try:
+        response_data = await resolve_miss(query, cache_key)
+        inflight.set_result(response_data)
+        return response_data
+    except Exception as e:
+        inflight.set_exception(e)
+        raise
+    finally:
+        del _inflight[cache_key]
+        if not inflight.done():
+            # We were cancelled; fail the followers rather than leave them hanging
+            inflight.set_exception(RuntimeError("Response generation was cancelled"))
+        # Mark any exception as retrieved so asyncio doesn't warn when no one waited
+        inflight.exception()
+
+def get_client_id(http_request: Request) -> str:
+    """Identify the caller by X-Client-ID header, falling back to the remote address"""
+    return http_request.headers.get("x-client-id") or (
+        http_request.client.host if http_request.client else "anonymous"
+    )
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> bytes:
+    """Encode a server-sent event"""
+    payload = b"data: " + orjson.dumps(data) + b"\n\n"
+    if event:
+        payload = f"event: {event}\n".encode() + payload
+    return payload
+
+async def stream_and_cache(query: str, cache_key: bytes,
+                           lock_token: Optional[str] = None) -> AsyncIterator[bytes]:
+    """
+    Stream an AI response as server-sent events and cache the full text once
+    generation completes. A failed generation ends the stream with an error
+    event and nothing is cached. Releases the single-flight lock when done.
+    """
+    try:
+        chunks = []
+        try:
+            async for chunk in AIEngine.stream_response(query):
+                chunks.append(chunk)
+                yield sse_event({"delta": chunk})
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+            return
+        
+        response_data = {
+            "query": query,
+            "response": "".join(chunks),
+            "cached": False,
+            "timestamp": time.time()
+        }
+        await cache.set(cache_key, response_data, expiration=CACHE_TTL, notify=True)
+        yield sse_event(response_data, event="done")
+    finally:
+        if lock_token:
+            # Shielded: on client disconnect this runs in a cancelled scope, and
+            # an unreleased lock would block the key until its TTL expires
+            await asyncio.shield(cache.release_lock(cache_key, lock_token))
+
+async def stream_cached(cached_response: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """Replay a cached response as server-sent events"""
+    yield sse_event({"delta": cached_response["response"]})
+    yield sse_event(cached_response, event="done")
+
+def cached_chat_response(cached_response: Dict[str, Any], stream: bool):
+    """
+    Build the /chat response for a cache hit.
+    
+    Cached entries were validated when they were generated, so the model is
+    built with model_construct and serialized directly; returning a Response
+    also skips FastAPI's response_model re-validation.
+    """
+    cached_response = {**cached_response, "cached": True}
+    if stream:
+        return StreamingResponse(stream_cached(cached_response), media_type="text/event-stream")
+    chat_response = ChatResponse.model_construct(
+        query=cached_response["query"],
+        response=cached_response["response"],
+        cached=True,
+        timestamp=cached_response["timestamp"]
+    )
+    return Response(content=chat_response.model_dump_json(), media_type="application/json")
+
+def start_log_queue() -> None:
+    """
+    Move the root logger's handlers behind a QueueHandler drained by a
+    listener thread. Done at startup rather than import time, since the
+    module can be imported twice per process (as __main__ and as app.main).
+    """
+    global _log_listener, _log_handlers
+    root_logger = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root_logger.handlers):
+        return
+    _log_handlers = root_logger.handlers[:]
+    _log_listener = logging.handlers.QueueListener(
+        _log_queue, *_log_handlers, respect_handler_level=True
+    )
+    _log_listener.start()
+    root_logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+
+def stop_log_queue() -> None:
+    """Restore the original root handlers and flush the listener"""
+    global _log_listener
+    if _log_listener is None:
+        return
+    logging.getLogger().handlers = _log_handlers
+    _log_listener.stop()
+    _log_listener = None
+
+@app.on_event("startup")
+async def startup():
+    """Verify the Redis connection before serving requests"""
+    start_log_queue()
+    await cache.connect()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close Redis and upstream HTTP connections"""
+    await cache.close()
+    await http_client.aclose()
+    stop_log_queue()
 
 @app.get("/")
 async def root():
@@ -46,7 +292,8 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "/": "API information",
-            "/chat": "POST - Submit chat queries",
+            "/chat": "POST - Submit chat queries (Accept: text/event-stream to stream)",
+            "/chat/batch": "POST - Submit many chat queries at once",
             "/health": "GET - Health check",
             "/cache/stats": "GET - Cache statistics"
         }
@@ -57,7 +304,7 @@ async def health_check():
     """Health check endpoint"""
     try:
         # Test Redis connection
-        cache.redis_client.ping()
+        await cache.redis_client.ping()
         return {
             "status": "healthy", 
             "message": "AI Chatbot API is running",
@@ -71,59 +318,185 @@ async def health_check():
             "error": str(e)
         }
 
+async def answer_miss(query: str, cache_key: bytes, stream: bool):
+    """Build the /chat response for a cache miss"""
+    if not stream:
+        response_data = await coalesced_miss(query, cache_key)
+        return ChatResponse(**response_data)
+    
+    # Reuse a generation already in flight in this process, if any
+    inflight = _inflight.get(cache_key)
+    if inflight is not None:
+        return cached_chat_response(await asyncio.shield(inflight), stream)
+    
+    # Only one request per key calls the LLM; the rest wait for its result
+    token = uuid.uuid4().hex
+    cached_response, is_leader = await cache.get_or_lock(cache_key, token, ttl_ms=LOCK_TTL_MS)
+    if cached_response:
+        return cached_chat_response(cached_response, stream)
+    if is_leader is None:
+        # Redis unavailable - no one to wait for
+        return StreamingResponse(
+            stream_and_cache(query, cache_key),
+            media_type="text/event-stream"
+        )
+    if is_leader:
+        # The stream releases the lock once generation finishes
+        return StreamingResponse(
+            stream_and_cache(query, cache_key, lock_token=token),
+            media_type="text/event-stream"
+        )
+    cached_response = await wait_for_leader(cache_key)
+    if cached_response:
+        return cached_chat_response(cached_response, stream)
+    # Leader never delivered (crashed or timed out) - generate ourselves
+    return StreamingResponse(
+        stream_and_cache(query, cache_key),
+        media_type="text/event-stream"
+    )
+
+async def answer_query(query: str, stream: bool, client_id: str):
+    """Answer a chat query from the cache, generating it on a miss"""
+    # Generate cache key
+    cache_key = generate_cache_key(query)
+    
+    # Check cache first, sliding the TTL of hot keys
+    cached_response = await cache.get(cache_key, expiration=CACHE_TTL)
+    
+    if cached_response:
+        # Cache hit - return cached response
+        logger.debug("Cache HIT for query: '%s'", query)
+        return cached_chat_response(cached_response, stream)
+    else:
+        # Cache miss - generate new response
+        logger.debug("Cache MISS for query: '%s'", query)
+        
+        # Cap concurrent misses per client so one caller can't exhaust the
+        # upstream quota; hits never touch the limiter
+        slot_ids = [uuid.uuid4().hex]
+        if not await cache.acquire_slots(client_id, slot_ids, limit=CLIENT_CONCURRENCY_LIMIT,
+                                         ttl_ms=CLIENT_SLOT_TTL_MS):
+            raise HTTPException(status_code=429, detail="Too many concurrent requests")
+        
+        try:
+            response = await answer_miss(query, cache_key, stream)
+        except BaseException:
+            await cache.release_slots(client_id, slot_ids)
+            raise
+        if isinstance(response, StreamingResponse):
+            # Hold the slot until the stream has been fully sent
+            response.background = BackgroundTask(cache.release_slots, client_id, slot_ids)
+        else:
+            await cache.release_slots(client_id, slot_ids)
+        return response
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     """
     Process chat queries with Redis caching.
     
     Before generating a response, checks if the query already exists in Redis.
     If cache hit → returns the cached response.
     If cache miss → calls AI generation, stores in Redis, and returns it.
+    
+    Clients sending `Accept: text/event-stream` receive the response as
+    server-sent events while it is being generated.
     """
     try:
+        stream = "text/event-stream" in http_request.headers.get("accept", "")
         query = request.query.strip()
         if not query:
             raise HTTPException(status_code=400, detail="Query cannot be empty")
         
-        # Generate cache key
-        cache_key = generate_cache_key(query)
+        return await answer_query(query, stream, get_client_id(http_request))
+            
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error processing chat request: %s", e)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+
+async def keep_slots_alive(client_id: str, slot_ids: List[str]) -> None:
+    """Re-stamp limiter slots held by a long batch so they outlive CLIENT_SLOT_TTL_MS"""
+    while True:
+        await asyncio.sleep(CLIENT_SLOT_TTL_MS / 3000)
+        await cache.refresh_slots(client_id, slot_ids, ttl_ms=CLIENT_SLOT_TTL_MS)
+
+async def answer_batch(queries: List[str], client_id: str) -> List[Dict[str, Any]]:
+    """
+    Answer many queries: one MGET for the cache lookups, then concurrent
+    resolution of the distinct misses through the same in-process coalescing
+    and Redis lock as /chat.
+    
+    Each miss resolved concurrently holds one of the client's limiter slots,
+    so a batch generates at most as many at once as the client has free.
+    """
+    cache_keys = [generate_cache_key(query) for query in queries]
+    cached_responses = await cache.get_many(cache_keys)
+    
+    # Resolve each missing key only once, even if repeated in the batch
+    misses: Dict[bytes, str] = {}
+    for query, cache_key, cached_response in zip(queries, cache_keys, cached_responses):
+        if cached_response is None and cache_key not in misses:
+            misses[cache_key] = query
+    
+    resolved: Dict[bytes, Dict[str, Any]] = {}
+    if misses:
+        slot_ids = [uuid.uuid4().hex for _ in range(min(len(misses), CLIENT_CONCURRENCY_LIMIT))]
+        granted = await cache.acquire_slots(client_id, slot_ids, limit=CLIENT_CONCURRENCY_LIMIT,
+                                            ttl_ms=CLIENT_SLOT_TTL_MS)
+        if not granted:
+            raise HTTPException(status_code=429, detail="Too many concurrent requests")
+        slot_ids = slot_ids[:granted]
         
-        # Check cache first
-        cached_response = cache.get(cache_key)
+        semaphore = asyncio.Semaphore(granted)
         
-        if cached_response:
-            # Cache hit - return cached response
-            logger.info(f"Cache HIT for query: '{query}'")
-            return ChatResponse(
-                query=cached_response["query"],
-                response=cached_response["response"],
-                cached=True,
-                timestamp=cached_response["timestamp"]
-            )
-        else:
-            # Cache miss - generate new response
-            logger.info(f"Cache MISS for query: '{query}'")
-            
-            # Generate AI response
-            ai_response = await AIEngine.generate_response(query)
-            
-            # Prepare response data
-            response_data = {
-                "query": query,
-                "response": ai_response,
-                "cached": False,
-                "timestamp": time.time()
-            }
-            
-            # Store in cache with 10-minute expiration
-            cache.set(cache_key, response_data, expiration=600)
-            
-            return ChatResponse(**response_data)
+        async def resolve(query: str, cache_key: bytes) -> Dict[str, Any]:
+            async with semaphore:
+                return await coalesced_miss(query, cache_key)
+        
+        tasks = [
+            asyncio.create_task(resolve(query, cache_key))
+            for cache_key, query in misses.items()
+        ]
+        heartbeat = asyncio.create_task(keep_slots_alive(client_id, slot_ids))
+        try:
+            responses = await asyncio.gather(*tasks)
+        finally:
+            # On failure, stop the remaining generations before freeing their slots
+            heartbeat.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(heartbeat, *tasks, return_exceptions=True)
+            await cache.release_slots(client_id, slot_ids)
+        resolved = dict(zip(misses, responses))
+    
+    return [
+        {**cached_response, "cached": True} if cached_response is not None else resolved[cache_key]
+        for cache_key, cached_response in zip(cache_keys, cached_responses)
+    ]
+
+@app.post("/chat/batch", response_model=List[ChatResponse])
+async def chat_batch(request: BatchChatRequest, http_request: Request):
+    """
+    Process many chat queries in a single request.
+    
+    Responses are returned in the same order as the queries.
+    """
+    try:
+        queries = [query.strip() for query in request.queries]
+        if not all(queries):
+            raise HTTPException(status_code=400, detail="Queries cannot be empty")
+        
+        return await answer_batch(queries, get_client_id(http_request))
             
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error processing chat request: {e}")
+        logger.error("Error processing batch chat request: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
@@ -134,7 +507,7 @@ async def cache_stats():
     """Get cache statistics"""
     try:
         # Get Redis info
-        info = cache.redis_client.info()
+        info = await cache.redis_client.info()
         
         return {
             "redis_version": info.get("redis_version"),
@@ -146,7 +519,7 @@ async def cache_stats():
             "hit_rate": info.get("keyspace_hits", 0) / max(1, info.get("keyspace_hits", 0) + info.get("keyspace_misses", 0))
         }
     except Exception as e:
-        logger.error(f"Error getting cache stats: {e}")
+        logger.error("Error getting cache stats: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Error getting cache statistics: {str(e)}"
@@ -156,13 +529,13 @@ async def cache_stats():
 async def clear_cache():
     """Clear all cached responses"""
     try:
-        success = cache.clear_all()
+        success = await cache.clear_all()
         if success:
             return {"message": "Cache cleared successfully"}
         else:
             raise HTTPException(status_code=500, detail="Failed to clear cache")
     except Exception as e:
-        logger.error(f"Error clearing cache: {e}")
+        logger.error("Error clearing cache: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"Error clearing cache: {str(e)}"
@@ -170,4 +543,13 @@ async def clear_cache():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers are spawned processes that import the app themselves, so each
+    # gets its own Redis pool and event loop
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count()
+    )